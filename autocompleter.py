@@ -5,16 +5,28 @@ https://github.com/diegoo/mineria_de_texto/blob/master/clase.7/5_Language_Models
 
 """
 
-import json
-import pickle
-import nltk
+import collections
+import functools
+import itertools
+import multiprocessing
+import numpy as np
 import util
-from nltk.lm import counter
-from nltk import tokenize
 
-DEFAULT_FILENAME = "autocompleter.pkl"
+DEFAULT_FILENAME = "autocompleter.npz"
 RIGHT_SENT_PAD = "</s>"
 LEFT_SENT_PAD = "<s>"
+PREPROCESS_BATCH_SIZE = 1000
+PREPROCESS_PENDING_BATCHES_PER_JOB = 2
+CACHE_SIZE = 4096
+IN_VOCABULARY_COUNT_THRESHOLD = 50
+ENTITY_ENCODING_MIN_WORDS = 3
+TOP_K_BY_FIRST_CHAR = 32
+_NO_WORD_IDS = np.empty(0, dtype=np.int32)
+
+# Words following the contexts of a given length, in compressed sparse row layout. Contexts are identified by a
+# key packing their word ids (see _context_keys) and sorted by it. The words following the i-th context are
+# word_ids[row_starts[i]:row_starts[i + 1]], sorted by count in descending order
+_NextWordsTable = collections.namedtuple("_NextWordsTable", ["context_keys", "row_starts", "word_ids", "counts"])
 
 
 class Autocompleter:
@@ -24,7 +36,7 @@ class Autocompleter:
     using up to trigrams and a train corpus is needed to construct the model
 
     Attributes:
-        ngram_counter: NgramCounter used to count the ngrams generated from the train text.
+        vocabulary: list with the words of the model, the position of a word in the list is its id.
 
     Typical usage example:
 
@@ -34,11 +46,19 @@ class Autocompleter:
     """
 
     def __init__(self):
-        """Initializes ngram_counter to none"""
-
-        self.ngram_counter = None
-
-    def fit(self, json_filename, company_group_id_filter=None, verbose=False):
+        """Initializes an empty (non fitted) model"""
+
+        self.vocabulary = []
+        self._word_ids = {}
+        self._unigram_counts = np.empty(0, dtype=np.int64)
+        self._next_words = {1: _group_by_context({}, 0), 2: _group_by_context({}, 0)}
+        self._context_rows = {1: {}, 2: {}}
+        self._top_next_words = {1: [], 2: []}
+        self._next_words_by_first_char = {}
+        self._casing = {}
+        self._reset_caches()
+
+    def fit(self, json_filename, company_group_id_filter=None, verbose=False, n_jobs=1):
         """Fits the model with the text in a json file.
 
         A first step of text pre-processing is performed before model construction. This
@@ -51,51 +71,35 @@ class Autocompleter:
             company_group_id_filter: list of company group ids to consider in the json file. If None,
                 then all companies are considered
             verbose: controls the verbosity level (on/off)
+            n_jobs: number of processes used to sentence tokenize and pre-process the messages
 
         Raises:
             FileNotFoundError: if json_filename does not exist.
         """
 
-        print("Autocompleter fit step 1/7: loading json file...", end='') if verbose else None
-        conversations = json.load(open(json_filename))
-        operator_messages = util.get_operator_messages(conversations, company_group_id_filter)
-        print("done") if verbose else None
-
-        # Sentence tokenize the text
-        print("Autocompleter fit step 2/7: sentence tokenize..", end='') if verbose else None
-        tokenized_sentences = util.sentence_tokenize(operator_messages)
-        print("done") if verbose else None
-
-        # Format sentences, e.g. lower case all text
-        print("Autocompleter fit step 3/7: format and clean...", end='') if verbose else None
-        tokenized_sentences = [util.format_and_clean(sentence) for sentence in tokenized_sentences]
-        print("done") if verbose else None
-
-        # Spell correct the sentences
-        print("Autocompleter fit step 4/7: spell correct...", end='') if verbose else None
-        tokenized_sentences = [util.spell_correction(sentence) for sentence in tokenized_sentences]
-        print("done") if verbose else None
-
-        # Replace named entities with special labels
-        print("Autocompleter fit step 5/7: encode named entities, this may take a few minutes...", end='') if verbose else None
-        tokenized_sentences = [util.encode_entities(sentence) for sentence in tokenized_sentences]
-        print("done") if verbose else None
-
-        # Word tokenize
-        print("Autocompleter fit step 6/7: word tokenize...", end='') if verbose else None
-        tokenized_words = [tokenize.word_tokenize(sentence) for sentence in tokenized_sentences]
+        # Stream the operator messages from the json file and sentence tokenize them
+        print("Autocompleter fit step 1/2: loading json file and sentence tokenize...", end='') if verbose else None
+        operator_messages = util.get_operator_messages_stream(json_filename, company_group_id_filter)
+        tokenized_sentences = util.sentence_tokenize(operator_messages, n_jobs)
+        casing = util.learn_casing(tokenized_sentences)
         print("done") if verbose else None
 
-        # Construct ngrams with left and right padding using <s> and </s> correspondingly
-        # and construct an n gram counter
-        print("Autocompleter fit step 7/7: model construction...", end='') if verbose else None
-        trigrams = [nltk.ngrams(sentence, 3, True, True, LEFT_SENT_PAD, RIGHT_SENT_PAD) for sentence in tokenized_words]
-        bigrams = [nltk.ngrams(sentence, 2, True, True, LEFT_SENT_PAD, RIGHT_SENT_PAD) for sentence in tokenized_words]
-        unigrams = [nltk.ngrams(sentence, 1, True, True, LEFT_SENT_PAD, RIGHT_SENT_PAD) for sentence in tokenized_words]
-        self.ngram_counter = counter.NgramCounter(trigrams+bigrams+unigrams)
+        # Format and clean, spell correct, replace named entities with special labels and word tokenize.
+        # Then count the ngrams with left and right padding using <s> and </s> correspondingly.
+        # Sentences are streamed through the pre-processing into the counters, so the intermediate results are
+        # never stored for the whole corpus (only for a few batches per job, see _preprocess)
+        print("Autocompleter fit step 2/2: pre-process sentences and construct model, "
+              "this may take a few minutes...", end='') if verbose else None
+        tokenized_words = _preprocess(tokenized_sentences, n_jobs)
+        word_ids = {}
+        ngram_counts = util.count_ngrams(tokenized_words, word_ids, LEFT_SENT_PAD, RIGHT_SENT_PAD)
+        self._build_tables(word_ids, *ngram_counts)
+        self._casing = casing
+        self._reset_caches()
         print("done") if verbose else None
 
-        print(self.ngram_counter) if verbose else None
+        print(f"Autocompleter model with {len(self.vocabulary)} words, {len(ngram_counts[1])} bigrams "
+              f"and {len(ngram_counts[2])} trigrams") if verbose else None
 
     def generate_completions(self, prefix_string, max_sentence_length=6, max_num_of_sentences=2 ):
         """Generate at most max_num_of_sentences sentences of at most max_sentence_length matching a prefix string.
@@ -117,22 +121,35 @@ class Autocompleter:
         """
 
         # Return empty if not initialized
-        if self.ngram_counter is None:
+        if not self.vocabulary:
             return []
 
+        return list(self._completions_cache(prefix_string, max_sentence_length, max_num_of_sentences))
+
+    def _compute_completions(self, prefix_string, max_sentence_length, max_num_of_sentences):
+        """Uncached generate_completions, returns a tuple so that results can be safely memoized"""
+
         # Pre-process incoming text: clean & format, spell correct, entity encode, tokenize...
+        # The last word is not spell corrected unless it is followed by a space, since it is usually being typed
+        # (an incomplete last word is used as the start string of the next word search).
+        # Named entities are hardly recognized in a few words, so short texts are not entity encoded
         prefix_string = util.format_and_clean(prefix_string)
-        prefix_string = util.spell_correction(prefix_string)
-        prefix_string = util.encode_entities(prefix_string)
-        tokenized_words = tokenize.word_tokenize(prefix_string)
+        if prefix_string[-1:].isspace():
+            prefix_string = util.spell_correction(prefix_string)
+        else:
+            typed_words, separator, last_word = prefix_string.rpartition(" ")
+            prefix_string = util.spell_correction(typed_words) + separator + last_word
+        if len(prefix_string.split()) >= ENTITY_ENCODING_MIN_WORDS:
+            prefix_string = util.encode_entities(prefix_string)
+        tokenized_words = util.word_tokenize(prefix_string)
 
         # If no tokenized words, the return empty
         if len(tokenized_words) == 0:
-            return []
+            return ()
 
         # Check if last word is in vocabulary, if not use it as the start condition for the next top word search
         start_string = ""
-        if not self.in_vocabulary(tokenized_words[-1]):
+        if not self._in_vocabulary(tokenized_words[-1]):
             start_string = tokenized_words[-1]
             del tokenized_words[-1]
 
@@ -140,22 +157,31 @@ class Autocompleter:
         top_predicted_words = self.get_next_word(tokenized_words, top_n=max_num_of_sentences, start_string=start_string)
 
         # Generate N sentences by using the first N words predicted as prefixes
-        # Each sentence returned by get_sentence method is detokenized and true cased
+        # The words shared by all the sentences are true cased once with the learned casing, so only the words
+        # generated for each sentence are true cased. Sentences are still detokenized as a whole, since the
+        # detokenizer rules depend on the surrounding words (e.g. "can not" -> "cannot").
+        # If some word is not in the casing dictionary, the detokenized sentence is true cased as a whole
+        true_cased_prefix = util.get_true_case_words(tokenized_words, self._casing)
         completions = []
         for word in top_predicted_words:
             sentence_seed = tokenized_words + [word]
-            sentence = self.get_sentence(sentence_seed, max_sentence_length)
-            sentence = tokenize.treebank.TreebankWordDetokenizer().detokenize(sentence)
-            sentence = util.get_true_case(sentence)
-            completions.append(sentence)
-
-        return completions
-
-    def in_vocabulary(self, word, count_threshold=50):
+            sentence = self._get_sentence_generator(max_sentence_length)(sentence_seed)
+            true_cased_words = None
+            if true_cased_prefix is not None:
+                generated_words = util.get_true_case_words(sentence[len(tokenized_words):], self._casing,
+                                                           sentence_start=False)
+                if generated_words is not None:
+                    true_cased_words = true_cased_prefix + generated_words
+            if true_cased_words is not None:
+                completions.append(util.detokenize(true_cased_words))
+            else:
+                completions.append(util.get_true_case(util.detokenize(sentence), self._casing))
+
+        return tuple(completions)
+
+    def in_vocabulary(self, word, count_threshold=IN_VOCABULARY_COUNT_THRESHOLD):
         """Returns true if word is in vocabulary more than count_threshold times"""
-        if self.ngram_counter is None:
-            return False
-        return self.ngram_counter[word] > count_threshold
+        return _in_vocabulary(self._word_ids, self._unigram_counts, count_threshold, word)
 
     def get_sentence(self, prefix_string, max_sentence_length=8):
         """Get sentences of max_sentence_length at most, matching a prefix string.
@@ -175,26 +201,64 @@ class Autocompleter:
         """
 
         # Return empty if not initialized
-        if self.ngram_counter is None:
+        if not self.vocabulary:
             return []
 
         # Check max sentence length precondition
         if len(prefix_string) >= max_sentence_length or len(prefix_string) == 0:
             return prefix_string
 
-        # Copy prefix_string
-        prefix_string = list(prefix_string)
+        return self._get_sentence_generator(max_sentence_length)(prefix_string)
+
+    def _get_sentence_generator(self, max_sentence_length):
+        """Returns the sentence generator specialized for max_sentence_length, creating it on first use"""
+
+        sentence_generator = self._sentence_generators.get(max_sentence_length)
+        if sentence_generator is None:
+            sentence_generator = self._make_sentence_generator(max_sentence_length)
+            self._sentence_generators[max_sentence_length] = sentence_generator
+        return sentence_generator
 
-        # Construct sentence starting with string_prefix and with max_sentence_length words
-        # If sentence terminator is reached or no more words are predicted, the return with current sentence
-        sentence = prefix_string
-        for i in range(max_sentence_length-len(prefix_string)):
-            word = self.get_next_word(sentence, 1)
-            if len(word) == 0 or word[0] == RIGHT_SENT_PAD:
+    def _make_sentence_generator(self, max_sentence_length):
+        """Returns the loop of get_sentence specialized for max_sentence_length.
+
+        The constants and the model indexes are bound as default arguments and the next word lookup
+        (see _find_context and _get_top_next_word) is inlined, so the loop reads them as locals instead of
+        looking up globals and attributes on every word.
+        """
+
+        def generate_sentence(prefix_string, word_ids=self._word_ids, context_rows=self._context_rows,
+                              top_next_words=self._top_next_words, vocabulary_size=len(self.vocabulary),
+                              right_sent_pad=RIGHT_SENT_PAD, max_sentence_length=max_sentence_length):
+            # Construct sentence starting with string_prefix and with max_sentence_length words
+            # If sentence terminator is reached or no more words are predicted, the return with current sentence
+            # The context (ids of the last two words of the sentence) is rolled forward on every step
+            sentence = list(prefix_string)
+            context_ids = [word_ids.get(word) for word in sentence[-2:]]
+            if None in context_ids:
                 return sentence
-            sentence.append(word[0])
 
-        return sentence
+            for i in range(max_sentence_length - len(sentence)):
+                if len(context_ids) == 2:
+                    row = context_rows[2].get(context_ids[0] * vocabulary_size + context_ids[1])
+                else:
+                    row = context_rows[1].get(context_ids[0])
+                if row is None:
+                    return sentence
+                word = top_next_words[len(context_ids)][row]
+                if word == right_sent_pad:
+                    return sentence
+                sentence.append(word)
+                context_ids = [context_ids[-1], word_ids[word]]
+
+            return sentence
+
+        return generate_sentence
+
+    def _make_in_vocabulary(self, count_threshold):
+        """Returns in_vocabulary specialized for count_threshold, with the model tables bound as arguments"""
+
+        return functools.partial(_in_vocabulary, self._word_ids, self._unigram_counts, count_threshold)
 
     def get_next_word(self, prefix_string, top_n=1, start_string=""):
         """Get next top n most probable words that should follow a string prefix.
@@ -215,30 +279,284 @@ class Autocompleter:
         """
 
         # Return empty if not initialized
-        if self.ngram_counter is None:
+        if not self.vocabulary:
             return []
 
         # Precondition: we need at least two words to generate the next word
         if len(prefix_string) < 1:
             return []
 
-        # Copy prefix string
-        prefix_string = list(prefix_string)
-
         # Get top n words conditioned on last two words that start with start_string
         conditional_word_tuple = tuple(prefix_string[-2:])
-        number_of_words = self.ngram_counter.unigrams.N()
-        predicted_words = self.ngram_counter[conditional_word_tuple].most_common(number_of_words)
-        top_n_words = [word for word, frequency in predicted_words if word.startswith(start_string)][:top_n]
-        return top_n_words
+        return list(self._next_word_cache(conditional_word_tuple, top_n, start_string))
+
+    def _compute_next_word(self, conditional_word_tuple, top_n, start_string):
+        """Uncached get_next_word, returns a tuple so that results can be safely memoized"""
+
+        table, row = self._find_context(conditional_word_tuple)
+        if table is None:
+            return ()
+
+        # Search first among the most probable words starting with the same character as start_string.
+        # If less than TOP_K_BY_FIRST_CHAR words are indexed, then those are all the words starting with that character
+        if start_string:
+            index_key = (len(conditional_word_tuple), row, start_string[0])
+            word_ids = self._next_words_by_first_char.get(index_key, _NO_WORD_IDS)
+            top_n_words = _top_n_with_prefix(word_ids, self.vocabulary, top_n, start_string)
+            if len(top_n_words) >= top_n or len(word_ids) < TOP_K_BY_FIRST_CHAR:
+                return tuple(top_n_words)
+
+        word_ids = table.word_ids[table.row_starts[row]:table.row_starts[row + 1]]
+        return tuple(_top_n_with_prefix(word_ids, self.vocabulary, top_n, start_string))
+
+    def _get_top_next_word(self, conditional_word_tuple):
+        """Returns the most probable word following a context, or None if the context was never seen"""
+
+        table, row = self._find_context(conditional_word_tuple)
+        if table is None:
+            return None
+        return self._top_next_words[len(conditional_word_tuple)][row]
+
+    def _reset_caches(self):
+        """Creates empty caches for the completions and next words, and the functions specialized for the model.
+
+        Must be called every time the model changes.
+        """
+
+        self._completions_cache = functools.lru_cache(maxsize=CACHE_SIZE)(self._compute_completions)
+        self._next_word_cache = functools.lru_cache(maxsize=CACHE_SIZE)(self._compute_next_word)
+        self._sentence_generators = {}
+        self._in_vocabulary = self._make_in_vocabulary(IN_VOCABULARY_COUNT_THRESHOLD)
+
+    def _build_tables(self, word_ids, unigram_counts, bigram_counts, trigram_counts):
+        """Builds the vocabulary, the unigram counts and the tables of the words that follow every context.
+
+        There is one table for the contexts of one word (from the bigrams) and one for the contexts of two words
+        (from the trigrams). The words following a context are sorted by count in descending order (ties keep the
+        order of first occurrence). Finding the most probable next words is then a linear scan over a slice of
+        the table, that can stop as soon as enough words are found.
+
+        Args:
+            word_ids: dictionary word -> id, ids must be consecutive and start at 0
+            xyz_counts: ngram counters as returned by util.count_ngrams
+        """
+
+        self.vocabulary = list(word_ids)
+        self._word_ids = dict(word_ids)
+
+        self._unigram_counts = np.zeros(len(self.vocabulary), dtype=np.int64)
+        self._unigram_counts[list(unigram_counts)] = list(unigram_counts.values())
+
+        self._next_words = {1: _group_by_context(bigram_counts, len(self.vocabulary)),
+                            2: _group_by_context(trigram_counts, len(self.vocabulary))}
+        self._build_context_index()
+        self._build_first_char_index()
+
+    def _build_context_index(self):
+        """Indexes the rows of the next words tables by context key.
+
+        The index is a dictionary per context length, context key -> row. Keys are plain ints, so a context is
+        found with a single dictionary lookup instead of a binary search over the numpy keys of the table.
+        The most probable word following every context is also kept in a list per context length, indexed by row.
+        """
+
+        self._context_rows = {}
+        self._top_next_words = {}
+        for context_length, table in self._next_words.items():
+            self._context_rows[context_length] = dict(zip(table.context_keys.tolist(), range(len(table.context_keys))))
+            top_word_ids = table.word_ids[table.row_starts[:-1]].tolist()
+            self._top_next_words[context_length] = [self.vocabulary[word_id] for word_id in top_word_ids]
+
+    def _build_first_char_index(self):
+        """Indexes the TOP_K_BY_FIRST_CHAR most probable words following every context by their first character.
+
+        The index is a dictionary (context length, context row, character) -> word ids sorted by count in
+        descending order. It bounds the search of the words starting with a given string, whatever the number of
+        words following the context.
+        """
+
+        self._next_words_by_first_char = {}
+        vocabulary_first_chars = np.array([ord(word[0]) for word in self.vocabulary], dtype=np.int32)
+
+        for context_length, table in self._next_words.items():
+            context_rows = np.repeat(np.arange(len(table.context_keys)), np.diff(table.row_starts))
+            first_chars = vocabulary_first_chars[table.word_ids]
+
+            # Stable sort by context and first character, so words keep their count order
+            sorted_indices = np.lexsort((first_chars, context_rows))
+            word_ids = table.word_ids[sorted_indices]
+            keys = np.column_stack((context_rows[sorted_indices], first_chars[sorted_indices]))
+            group_starts = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+            group_starts = np.concatenate(([0], group_starts)) if len(keys) else group_starts
+            group_ends = np.append(group_starts[1:], len(word_ids))
+
+            for start, end, (row, first_char) in zip(group_starts.tolist(), group_ends.tolist(),
+                                                     keys[group_starts].tolist()):
+                end = min(end, start + TOP_K_BY_FIRST_CHAR)
+                self._next_words_by_first_char[context_length, row, chr(first_char)] = word_ids[start:end]
+
+    def _find_context(self, conditional_word_tuple):
+        """Finds a context of one or two words in the next words tables.
+
+        Returns:
+            The table of the contexts of the same length and the row of the context in the table,
+            or (None, -1) if the context was never seen
+        """
+
+        context_ids = [self._word_ids.get(word) for word in conditional_word_tuple]
+        if None in context_ids:
+            return None, -1
+
+        # Same key than _context_keys, computed with Python ints
+        context_key = 0
+        for word_id in context_ids:
+            context_key = context_key * len(self.vocabulary) + word_id
+
+        row = self._context_rows[len(context_ids)].get(context_key)
+        if row is None:
+            return None, -1
+        return self._next_words[len(context_ids)], row
 
     def save(self, filename=DEFAULT_FILENAME):
-        """Saves the serialized model to filename."""
+        """Saves the model to filename as a compressed numpy archive.
+
+        Words are stored as integer ids in the vocabulary. The arrays of the next words tables (one for bigram and
+        one for trigram contexts) are stored as they are. The learned casing of the words is stored as an array of
+        true cased words.
+        """
+
+        arrays = {"vocabulary": np.array(self.vocabulary, dtype=str), "unigram_counts": self._unigram_counts,
+                  "casing": np.array(list(self._casing.values()), dtype=str)}
+        for context_length, name in ((1, "bigram"), (2, "trigram")):
+            for field, array in self._next_words[context_length]._asdict().items():
+                arrays[name + "_" + field] = array
+
         with open(filename, "wb") as f:
-            pickle.dump(self, f)
+            np.savez_compressed(f, **arrays)
 
     @classmethod
     def load(cls, filename=DEFAULT_FILENAME):
-        """De-serializes the model from filename."""
-        with open(filename, "rb") as f:
-            return pickle.load(f)
+        """Loads a model saved with save from filename."""
+
+        autocompleter = cls()
+        with np.load(filename) as arrays:
+            autocompleter.vocabulary = arrays["vocabulary"].tolist()
+            autocompleter._word_ids = {word: word_id for word_id, word in enumerate(autocompleter.vocabulary)}
+            autocompleter._unigram_counts = arrays["unigram_counts"]
+            autocompleter._casing = {word.lower(): word for word in arrays["casing"].tolist()}
+            for context_length, name in ((1, "bigram"), (2, "trigram")):
+                table = _NextWordsTable(*(arrays[name + "_" + field] for field in _NextWordsTable._fields))
+                autocompleter._next_words[context_length] = table
+        autocompleter._build_context_index()
+        autocompleter._build_first_char_index()
+        autocompleter._reset_caches()
+
+        return autocompleter
+
+
+def _in_vocabulary(word_ids, unigram_counts, count_threshold, word):
+    """Returns true if word is in word_ids and its unigram count is greater than count_threshold.
+
+    word is the last argument so that the model tables and the threshold can be bound with functools.partial.
+    """
+
+    word_id = word_ids.get(word)
+    if word_id is None:
+        return False
+    return bool(unigram_counts[word_id] > count_threshold)
+
+
+def _context_keys(contexts, vocabulary_size):
+    """Packs the word ids of every context (one context per row) into a single integer key.
+
+    Keys are ordered as the contexts are (lexicographically), and are unique given the vocabulary size.
+    """
+
+    keys = np.zeros(len(contexts), dtype=np.uint64)
+    for column in range(contexts.shape[1]):
+        keys = keys * np.uint64(vocabulary_size) + contexts[:, column].astype(np.uint64)
+    return keys
+
+
+def _group_by_context(ngram_counts, vocabulary_size):
+    """Groups the ngram counts by context (all the ngram words but the last one).
+
+    Args:
+        ngram_counts: counter of ngrams of the same order, as tuples of word ids
+        vocabulary_size: number of words of the vocabulary
+
+    Returns:
+        A _NextWordsTable with the words following every context sorted by count in descending order
+    """
+
+    if not ngram_counts:
+        return _NextWordsTable(np.empty(0, dtype=np.uint64), np.zeros(1, dtype=np.int64), _NO_WORD_IDS, _NO_WORD_IDS)
+
+    ngrams = np.array(list(ngram_counts), dtype=np.int32)
+    counts = np.fromiter(ngram_counts.values(), dtype=np.int32, count=len(ngram_counts))
+
+    # Stable sort by context and then by decreasing count, so ties keep the order of first occurrence
+    context_columns = [ngrams[:, i] for i in reversed(range(ngrams.shape[1] - 1))]
+    sorted_indices = np.lexsort([-counts] + context_columns)
+    ngrams = ngrams[sorted_indices]
+
+    # A new row starts where the context changes
+    context_keys = _context_keys(ngrams[:, :-1], vocabulary_size)
+    row_starts = np.flatnonzero(context_keys[1:] != context_keys[:-1]) + 1
+    row_starts = np.concatenate(([0], row_starts, [len(ngrams)])).astype(np.int64)
+    return _NextWordsTable(context_keys[row_starts[:-1]], row_starts, ngrams[:, -1], counts[sorted_indices])
+
+
+def _top_n_with_prefix(word_ids, vocabulary, top_n, start_string):
+    """Returns the first top_n words starting with start_string, word_ids must be sorted by decreasing probability"""
+
+    top_n_words = []
+    if top_n < 1:
+        return top_n_words
+
+    for word_id in word_ids:
+        word = vocabulary[word_id]
+        if word.startswith(start_string):
+            top_n_words.append(word)
+            if len(top_n_words) == top_n:
+                break
+
+    return top_n_words
+
+
+def _preprocess(sentences, n_jobs=1):
+    """Generates the list of words of every sentence after pre-processing it (see _preprocess_batch).
+
+    Sentences are pre-processed in batches, in parallel if more than one job is requested. Then at most
+    PREPROCESS_PENDING_BATCHES_PER_JOB batches per job are submitted ahead of the one being consumed
+    (Pool.imap would submit all the batches at once).
+    """
+
+    sentences = iter(sentences)
+    batches = iter(lambda: list(itertools.islice(sentences, PREPROCESS_BATCH_SIZE)), [])
+    if n_jobs > 1:
+        with multiprocessing.Pool(processes=n_jobs) as pool:
+            pending_batches = collections.deque()
+            for batch in batches:
+                pending_batches.append(pool.apply_async(_preprocess_batch, (batch,)))
+                if len(pending_batches) > PREPROCESS_PENDING_BATCHES_PER_JOB * n_jobs:
+                    yield from pending_batches.popleft().get()
+            while pending_batches:
+                yield from pending_batches.popleft().get()
+    else:
+        for batch in batches:
+            yield from _preprocess_batch(batch)
+
+
+def _preprocess_batch(sentences):
+    """Format and clean, spell correct, encode entities and word tokenize a list of sentences.
+
+    Defined at module level so that it can be dispatched to a pool of worker processes.
+
+    Returns:
+        A list with the list of words of every sentence
+    """
+
+    sentences = [util.spell_correction(util.format_and_clean(sentence)) for sentence in sentences]
+    sentences = util.encode_entities_batch(sentences)
+    return [util.word_tokenize(sentence) for sentence in sentences]
@@ -1,6 +1,7 @@
 """ Tests to validate that the autocompleter functions correctly."""
 
 import autocompleter
+import copy
 import pytest
 import timeit
 
@@ -20,7 +21,11 @@ def auto_completer():
                          [("How can i", 10, 2, ['How can I assist you with today?', 'How can I help you with today?']),
                           ("How can i", 5, 2, ['How can I assist you', 'How can I help you']),
                           ("How can i", 5, 1, ['How can I assist you']),
-                          ("Are y", 5, 1, ['Are you aware of this']),
+                          ("Are y", 5, 1, ['Are you aware of that']),
+                          ("How can i hel", 5, 2, ['How can I help you']),
+                          ("I'm", 6, 2, ["I'm sorry to hear that", "I'm happy to assist you"]),
+                          ("it's", 6, 2, ["It's nice when it's", "It's an easy fix"]),
+                          ("Charged $50", 6, 2, ["Charged $50"]),
                           ("How", 5, 1, []),
                           ("", 5, 1, [])])
 def test_generate_completions(auto_completer, prefix, max_number_words, max_number_sentence, expected_output):
@@ -65,6 +70,21 @@ def test_get_next_word(auto_completer, prefix, top_n, start_string, expected_out
     assert completions == expected_output
 
 
+@pytest.mark.parametrize("prefix, top_n, start_string",
+                         [(["how"], 2, "mu"), (["how"], 4, "m"), (["how"], 3, "t"), (["can", "i"], 3, "a"),
+                          (["can", "i"], 2, "he"), (["you"], 5, "c"), (["you"], 3, "zz")])
+def test_get_next_word_with_small_first_char_index(auto_completer, monkeypatch, prefix, top_n, start_string):
+    """Words not indexed by first character must still be found, by searching all the words following the context"""
+    monkeypatch.setattr(autocompleter, "TOP_K_BY_FIRST_CHAR", 2)
+    completer = copy.copy(auto_completer)
+    completer._build_first_char_index()
+    completer._reset_caches()
+
+    all_next_words = auto_completer.get_next_word(prefix, len(auto_completer.vocabulary))
+    expected_output = [word for word in all_next_words if word.startswith(start_string)][:top_n]
+    assert completer.get_next_word(prefix, top_n, start_string) == expected_output
+
+
 @pytest.mark.parametrize("prefix, max_sentence_length, expected_output",
                          [(["how", "can", "i"], 4, ['how', 'can', 'i', 'assist']),
                           (["how", "can", "i"], 9, ['how', 'can', 'i', 'assist', 'you', 'with', 'today', '?']),
@@ -83,3 +103,27 @@ def test_in_vocabulary(auto_completer, word, count_threshold, expected_output):
     """Test some completion generations based on known results on the training conversations used"""
     completions = auto_completer.in_vocabulary(word, count_threshold)
     assert completions == expected_output
+
+
+def test_cached_results_are_not_shared(auto_completer):
+    """Modifying a returned list must not modify the results of the following (cached) calls"""
+    completions = auto_completer.generate_completions("How can i", 5, 2)
+    completions.append("Not a completion")
+    assert auto_completer.generate_completions("How can i", 5, 2) == ['How can I assist you', 'How can I help you']
+
+    next_words = auto_completer.get_next_word(["can", "i"], 2)
+    next_words.clear()
+    assert auto_completer.get_next_word(["can", "i"], 2) == ['assist', 'help']
+
+
+def test_save_and_load(auto_completer, tmp_path):
+    """A loaded model must generate the same completions than the saved one"""
+    filename = str(tmp_path / "autocompleter.npz")
+    auto_completer.save(filename)
+    loaded_completer = autocompleter.Autocompleter.load(filename)
+
+    assert loaded_completer.vocabulary == auto_completer.vocabulary
+    assert loaded_completer.in_vocabulary("your", 10) and not loaded_completer.in_vocabulary("your", 1000)
+    assert loaded_completer.get_next_word(["how"], 4) == auto_completer.get_next_word(["how"], 4)
+    assert loaded_completer.generate_completions("How can i", 10, 2) == \
+        auto_completer.generate_completions("How can i", 10, 2)
@@ -1,7 +1,9 @@
 """ Tests to validate the util functions."""
 
 import util
+import collections
 import json
+import nltk
 from nltk import tokenize
 import pytest
 
@@ -33,16 +35,31 @@ def test_get_operator_messages():
     assert all_companies_data == expected_all_companies_data
 
 
-def test_format_and_clean():
-    input_text = "This is a test <text>, to test the format_clean function."
-    expected_output = "this is a test to test the format_clean function"
+@pytest.mark.parametrize("company_group_id_filter", [[1], [2], [3], [1, 3], None])
+def test_get_operator_messages_stream(company_group_id_filter):
+    """Streamed messages must be the same as the ones found in the loaded json structure"""
+    json_filename = "tests/data/test_get_messages_data.json"
+    json_data = json.load(open(json_filename))
+
+    expected_output = util.get_operator_messages(json_data, company_group_id_filter)
+    assert list(util.get_operator_messages_stream(json_filename, company_group_id_filter)) == expected_output
+
+
+@pytest.mark.parametrize("input_text, expected_output",
+                         [("This is a test <text>, to test the format_clean function.",
+                           "this is a test to test the format_clean function"),
+                          ('Tags <b>next<i> to "words"  and   spaces <br> <br> here.',
+                           "tags next to words and spaces here"),
+                          ("A <multi\nline> tag is not a tag.", "a <multi\nline> tag is not a tag")])
+def test_format_and_clean(input_text, expected_output):
     assert util.format_and_clean(input_text) == expected_output
 
 
-def test_sentence_tokenize():
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_sentence_tokenize(n_workers):
     input_documents = ["This is a sentence of document 1. This is another sentence", "This is a second document"]
     expected_output = ["This is a sentence of document 1.", "This is another sentence", "This is a second document"]
-    assert util.sentence_tokenize(input_documents) == expected_output
+    assert util.sentence_tokenize(input_documents, n_workers) == expected_output
 
 
 def test_spell_correction():
@@ -92,3 +109,60 @@ def test_encode_entities():
     accuracy = 100*(total - differences)/total
 
     assert accuracy > ENTITY_ENCODER_ACCURACY
+
+
+def test_encode_entities_batch():
+    """Batch entity encoding must give the same results as the one document version"""
+    input_text = ["my name is james", "no entities here.", "i work at mbw", "my brother's name is john"]
+    expected_output = [util.encode_entities(text) for text in input_text]
+    assert util.encode_entities_batch(input_text) == expected_output
+
+
+def test_count_ngrams():
+    """Ngram counts of every order must match the ones of nltk.ngrams with the same padding"""
+    sentences = [["how", "can", "i", "help", "you", "?"], ["how", "can", "i"], ["hi"], []]
+    word_ids = {}
+    ngram_counts = util.count_ngrams(sentences, word_ids, "<s>", "</s>")
+    vocabulary = list(word_ids)
+    assert [word_ids[word] for word in vocabulary] == list(range(len(vocabulary)))
+
+    unigram_counts = {(vocabulary[word_id],): count for word_id, count in ngram_counts[0].items()}
+    bigram_counts, trigram_counts = [{tuple(vocabulary[word_id] for word_id in ngram): count
+                                      for ngram, count in counts.items()} for counts in ngram_counts[1:]]
+    for order, output in zip((1, 2, 3), (unigram_counts, bigram_counts, trigram_counts)):
+        expected_output = collections.Counter(ngram for sentence in sentences
+                                              for ngram in nltk.ngrams(sentence, order, True, True, "<s>", "</s>"))
+        assert output == expected_output
+
+
+def test_word_tokenize():
+    """Word tokenization of clean sentences must match nltk's and be reverted by detokenize"""
+    input_text = ["how can i help you today?", "i can't find my order", "it's on fire it's melting the carpet!",
+                  "i know it's", "they can't", "i'm"]
+    for text in input_text:
+        words = util.word_tokenize(text)
+        assert words == tokenize.word_tokenize(text)
+        assert util.detokenize(words) == text
+
+
+def test_true_case_with_learned_casing():
+    """True case using the casing learned from a text"""
+    casing = util.learn_casing(["I have been to India with my BMW.", "Then I went to Spain",
+                                "India is far away", "The BMW is a car and the car is red", "Is this a test?"])
+    assert casing["i"] == "I" and casing["india"] == "India" and casing["bmw"] == "BMW" and casing["the"] == "the"
+    assert "then" not in casing
+
+    assert util.get_true_case("then i went to india with the bmw", casing) == "Then I went to India with the BMW"
+    assert util.get_true_case("the car is red?", casing) == "The car is red?"
+
+
+def test_get_true_case_words():
+    """True casing words one by one must give the same casing than true casing the detokenized text"""
+    casing = util.learn_casing(["Then I went to India", "I think it's far away", "Can you help me?"])
+    words = ["then", "i", "went", "to", "india", "?"]
+    true_cased_words = util.get_true_case_words(words, casing)
+    assert true_cased_words == ["Then", "I", "went", "to", "India", "?"]
+    assert util.detokenize(true_cased_words) == util.get_true_case(util.detokenize(words), casing)
+
+    assert util.get_true_case_words(["it", "'s", "india"], casing, sentence_start=False) == ["it", "'s", "India"]
+    assert util.get_true_case_words(["went", "to", "spain"], casing) is None
@@ -2,15 +2,40 @@
 
 """
 
-import autocorrect
+import collections
+import ijson
+import itertools
+import multiprocessing
+import os
 import re
 import en_core_web_sm
 from nltk import tokenize
-from nltk.lm import preprocessing
+import symspellpy
+from symspellpy import SymSpell, Verbosity
 import truecase
 
-util_nlp = en_core_web_sm.load()
-util_spell_corrector = autocorrect.Speller(lang='en')
+util_nlp = en_core_web_sm.load(disable=["tagger", "parser"])
+util_spell_corrector = SymSpell(max_dictionary_edit_distance=2, prefix_length=7)
+util_spell_corrector.load_dictionary(os.path.join(os.path.dirname(symspellpy.__file__),
+                                                  "frequency_dictionary_en_82_765.txt"), term_index=0, count_index=1)
+util_detokenizer = tokenize.treebank.TreebankWordDetokenizer()
+
+# Words checked by the spell corrector, words with apostrophes (contractions) or shorter than
+# SPELL_CORRECTION_MIN_LENGTH letters (often chat abbreviations or incomplete words) are left untouched
+_WORD_RE = re.compile(r"[A-Za-z]+(?:'[A-Za-z]+)*")
+SPELL_CORRECTION_MIN_LENGTH = 3
+
+# Words (letters only) whose casing is learned by learn_casing
+_CASED_WORD_RE = re.compile(r"[^\W\d_]+")
+
+# Contractions that the treebank detokenizer only joins to the previous word when another word follows them
+_CONTRACTIONS = frozenset(["'s", "'m", "'d", "'re", "'ve", "'ll", "n't"])
+_TRAILING_CONTRACTION_RE = re.compile(r"([^' ]) ('s|'m|'d|'re|'ve|'ll|n't)$", re.IGNORECASE)
+
+# Pre-compiled cleaning operations used by format_and_clean
+_SYMBOLS_TRANSLATION_TABLE = str.maketrans('', '', '.,"')
+_TAG_RE = re.compile(r'<[^>\n]*>')
+_SPACES_RE = re.compile(r'  +')
 
 
 def get_operator_messages(json_conversation_structure, company_group_id_filter=None):
@@ -27,16 +52,44 @@ def get_operator_messages(json_conversation_structure, company_group_id_filter=N
         returned value is NOT sentence tokenized.
     """
 
-    operator_messages = []
-    for issue in json_conversation_structure["Issues"]:
-        if (company_group_id_filter is None) or (issue["CompanyGroupId"] in company_group_id_filter):
-            for message in issue["Messages"]:
-                if not message["IsFromCustomer"]:
-                    operator_messages.append(message["Text"])
+    company_group_ids = None if company_group_id_filter is None else frozenset(company_group_id_filter)
+    operator_messages = [message["Text"]
+                         for issue in json_conversation_structure["Issues"]
+                         if company_group_ids is None or issue["CompanyGroupId"] in company_group_ids
+                         for message in issue["Messages"]
+                         if not message["IsFromCustomer"]]
 
     return operator_messages
 
 
+def get_operator_messages_stream(json_filename, company_group_id_filter=None):
+    """Generates the messages of the operator found in a json file, without loading the whole file in memory.
+
+    Same as get_operator_messages, but the issues are parsed one at a time while the file is read.
+
+    Args:
+        json_filename: json file containing the operator messages, with the same structure used by
+            get_operator_messages.
+        company_group_id_filter: list of company group ids to consider in the json file. If None,
+            then all companies are considered
+
+    Returns:
+        A generator of operator messages. Every message can contain more than one sentence. The
+        generated messages are NOT sentence tokenized.
+
+    Raises:
+        FileNotFoundError: if json_filename does not exist.
+    """
+
+    company_group_ids = None if company_group_id_filter is None else frozenset(company_group_id_filter)
+    with open(json_filename, "rb") as f:
+        for issue in ijson.items(f, "Issues.item"):
+            if company_group_ids is None or issue["CompanyGroupId"] in company_group_ids:
+                for message in issue["Messages"]:
+                    if not message["IsFromCustomer"]:
+                        yield message["Text"]
+
+
 def format_and_clean(text):
     """Transform to lower case, cleans some symbols from the text, i.e., <>.,"
 
@@ -47,34 +100,120 @@ def format_and_clean(text):
         The cleaned and formatted text
     """
 
-    text = text.lower()
-    text = re.sub('<.*?>', '', text)
-    text = re.sub('[.,"]', '', text)
-    text = re.sub(' +', ' ', text)
+    text = text.lower().translate(_SYMBOLS_TRANSLATION_TABLE)
+    if '<' in text:
+        text = _TAG_RE.sub('', text)
+    if '  ' in text:
+        text = _SPACES_RE.sub(' ', text)
     return text
 
 
 def spell_correction(text):
     """Spell correct the input text"""
-    sentence = util_spell_corrector.autocorrect_sentence(text)
+    sentence = _WORD_RE.sub(_correct_word, text)
     return sentence
 
 
-def sentence_tokenize(documents):
+def _correct_word(match):
+    """Returns the most probable correction of the matched word, keeping its capitalization"""
+
+    word = match.group()
+    if len(word) < SPELL_CORRECTION_MIN_LENGTH or "'" in word:
+        return word
+
+    # Short words have many neighbours at distance 2, only allow a single edit for them
+    max_edit_distance = 1 if len(word) < 5 else 2
+    suggestions = util_spell_corrector.lookup(word.lower(), Verbosity.TOP, max_edit_distance=max_edit_distance,
+                                              include_unknown=True)
+    correction = suggestions[0].term
+    if word.isupper():
+        correction = correction.upper()
+    elif word[0].isupper():
+        correction = correction[0].upper() + correction[1:]
+    return correction
+
+
+def sentence_tokenize(documents, n_workers=1):
     """Returns a list of tokenized sentences
 
     Args:
-        documents: list of texts. Each element of the list can contain several sentences, e.g.:
+        documents: iterable of texts. Each element can contain several sentences, e.g.:
             ["This is the first document. Just another sentence.", "Second document.", "Hey! Last but not least."]
+        n_workers: number of processes tokenizing the documents in parallel
 
     Returns:
         Returns a list of tokenized sentences:
             ["This is the first document", "Just another sentence", "Second document", "Hey!", "Last but not least"]
     """
 
-    sentences = [tokenize.sent_tokenize(message) for message in  documents]
-    sentences = list(preprocessing.flatten(sentences))
-    return sentences
+    if n_workers > 1:
+        documents = list(documents)
+        chunksize = max(1, len(documents) // (n_workers * 8))
+        with multiprocessing.Pool(n_workers) as pool:
+            sentences = pool.map(tokenize.sent_tokenize, documents, chunksize=chunksize)
+    else:
+        sentences = map(tokenize.sent_tokenize, documents)
+
+    return list(itertools.chain.from_iterable(sentences))
+
+
+def word_tokenize(sentence):
+    """Returns the list of words of a sentence, e.g.: "how can i help you?" -> ["how", "can", "i", "help", "you", "?"]
+
+    The text is expected to be a single sentence, so the sentence splitting done by nltk's word_tokenize is skipped.
+    """
+
+    return tokenize.word_tokenize(sentence, preserve_line=True)
+
+
+def detokenize(words):
+    """Returns the sentence formed by a list of words, i.e. the inverse operation of word_tokenize"""
+
+    text = util_detokenizer.detokenize(words)
+    if words and words[-1].lower() in _CONTRACTIONS:
+        text = _TRAILING_CONTRACTION_RE.sub(r"\1\2", text)
+    return text
+
+
+def count_ngrams(tokenized_sentences, word_ids, left_pad_symbol, right_pad_symbol):
+    """Counts the padded unigrams, bigrams and trigrams of the tokenized sentences using integer word ids.
+
+    Sentences are padded as nltk.ngrams(sentence, n, True, True, left_pad_symbol, right_pad_symbol) does for every
+    order n. Every word is interned in word_ids before counting, so ngrams are counted as tuples of ints and
+    the counting loops run in C (collections.Counter.update).
+
+    Args:
+        tokenized_sentences: iterable of sentences, every sentence is a list of words
+        word_ids: dictionary word -> id, new words are added to it with consecutive ids
+        left_pad_symbol: symbol used to pad the beginning of the sentences
+        right_pad_symbol: symbol used to pad the end of the sentences
+
+    Returns:
+        A (unigram_counts, bigram_counts, trigram_counts) tuple of counters. Unigrams are counted by word id, bigrams
+        and trigrams by tuples of word ids. Ngrams are ordered by their first occurrence in the sentences.
+    """
+
+    left_pad_id = word_ids.setdefault(left_pad_symbol, len(word_ids))
+    right_pad_id = word_ids.setdefault(right_pad_symbol, len(word_ids))
+    unigram_counts = collections.Counter()
+    bigram_counts = collections.Counter()
+    trigram_counts = collections.Counter()
+
+    for sentence in tokenized_sentences:
+        ids = [left_pad_id, left_pad_id]
+        for word in sentence:
+            word_id = word_ids.get(word)
+            if word_id is None:
+                word_id = word_ids[word] = len(word_ids)
+            ids.append(word_id)
+        ids.append(right_pad_id)
+        ids.append(right_pad_id)
+
+        unigram_counts.update(ids[2:-2])
+        bigram_counts.update(zip(ids[1:-2], ids[2:-1]))
+        trigram_counts.update(zip(ids, ids[1:], ids[2:]))
+
+    return unigram_counts, bigram_counts, trigram_counts
 
 
 def encode_entities(document, person_label="__PER__", organization_label="__ORG__"):
@@ -90,8 +229,33 @@ def encode_entities(document, person_label="__PER__", organization_label="__ORG_
         The text with the entities replaced with the corresponding labels
     """
 
+    return _replace_entities(document, util_nlp(document), person_label, organization_label)
+
+
+def encode_entities_batch(documents, person_label="__PER__", organization_label="__ORG__", n_process=1):
+    """Same as encode_entities, but for a list of documents processed as a stream by the spacy pipeline
+
+    Batching amortizes the spacy pipeline overhead over many documents, so this function should be preferred
+    over encode_entities when a large amount of text has to be encoded, e.g. when fitting a model.
+
+    Args:
+        documents: list of input texts
+        xyz_label: the label that is going to be used to replace the entity xyz
+        n_process: number of processes used by spacy to run the named entity recognition
+
+    Returns:
+        A list with the texts with the entities replaced with the corresponding labels
+    """
+
+    nlp_documents = util_nlp.pipe(documents, batch_size=1000, n_process=n_process)
+    return [_replace_entities(nlp_document.text, nlp_document, person_label, organization_label)
+            for nlp_document in nlp_documents]
+
+
+def _replace_entities(document, nlp_document, person_label, organization_label):
+    """Replaces the entities found by spacy in nlp_document with the corresponding labels"""
+
     # Get entities from current document
-    nlp_document = util_nlp(document)
     entities = [(entity.text, entity.label_) for entity in nlp_document.ents]
 
     # Replace entities with corresponding labels
@@ -108,6 +272,79 @@ def encode_entities(document, person_label="__PER__", organization_label="__ORG_
     return document
 
 
-def get_true_case(text):
-    """Transform a text to its true case"""
+def learn_casing(sentences):
+    """Learns the most frequent casing of every word found in the sentences.
+
+    The first word of every sentence is not considered, since it is capitalized whatever its true case is.
+
+    Args:
+        sentences: list of sentences, in their original case
+
+    Returns:
+        A dictionary lower case word -> most frequent casing of the word, e.g. {"i": "I", "india": "India"}
+    """
+
+    casing_counts = collections.Counter()
+    for sentence in sentences:
+        casing_counts.update(_CASED_WORD_RE.findall(sentence)[1:])
+
+    casing = {}
+    best_counts = {}
+    for word, count in casing_counts.items():
+        lower_case_word = word.lower()
+        if count > best_counts.get(lower_case_word, 0):
+            casing[lower_case_word] = word
+            best_counts[lower_case_word] = count
+
+    return casing
+
+
+def get_true_case(text, casing=None):
+    """Transform a text to its true case
+
+    Args:
+        text: lower case input text
+        casing: dictionary lower case word -> true case word, as returned by learn_casing. If given, the words are
+            looked up in the dictionary and the text is capitalized. The truecase statistical model is only used if
+            casing is None or if some word (other than the first one) is not in the dictionary.
+
+    Returns:
+        The true cased text
+    """
+
+    if casing is not None:
+        words = _CASED_WORD_RE.findall(text)
+        if all(word in casing or not word.islower() for word in words[1:]):
+            text = _CASED_WORD_RE.sub(lambda match: casing.get(match.group(), match.group()), text)
+            return text[:1].upper() + text[1:]
+
     return truecase.get_true_case(text)
+
+
+def get_true_case_words(words, casing, sentence_start=True):
+    """Transform a list of words to their true case using only the casing dictionary (see get_true_case)
+
+    Args:
+        words: list of lower case words, as returned by word_tokenize
+        casing: dictionary lower case word -> true case word, as returned by learn_casing
+        sentence_start: whether the words start a sentence. If so, the first word is capitalized and it is
+            not required to be in the dictionary
+
+    Returns:
+        The list of true cased words, or None if some word is not in the dictionary
+    """
+
+    true_cased_words = []
+    for word in words:
+        true_cased_word = casing.get(word)
+        if true_cased_word is None:
+            is_first_word = sentence_start and not true_cased_words
+            if not is_first_word and any(part.islower() and part not in casing
+                                         for part in _CASED_WORD_RE.findall(word)):
+                return None
+            true_cased_word = _CASED_WORD_RE.sub(lambda match: casing.get(match.group(), match.group()), word)
+        true_cased_words.append(true_cased_word)
+
+    if sentence_start and true_cased_words:
+        true_cased_words[0] = true_cased_words[0][:1].upper() + true_cased_words[0][1:]
+    return true_cased_words